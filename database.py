@@ -1,44 +1,144 @@
 # database.py
 
+import asyncio
 import aiosqlite
 import logging
-import json
-from typing import List, Dict, Any, Optional
+import orjson
+import itertools
+from typing import List, Dict, Any, Optional, AsyncIterator
 from contextlib import asynccontextmanager
+from functools import lru_cache
 
 DB_PATH = "video_projects.db"
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# --- Shared Connections ---
+# main.lifespan opens one read-write connection and a small pool of read-only ones and
+# registers them here. All writes go through the single writer (SQLite serializes
+# them anyway); SELECTs use the readers so, under WAL, UI polling never queues behind
+# a write batch.
+_db: Optional[aiosqlite.Connection] = None
+_write_lock = asyncio.Lock()
+_read_pool: Optional[asyncio.Queue] = None
+
+READ_POOL_SIZE = 4
+
+# Database-level setting, persisted in the file; applied once by initialize_database.
+# Note: changing page_size on a WAL database requires switching to journal_mode=DELETE,
+# setting page_size, running VACUUM, and then re-enabling WAL.
+DATABASE_PRAGMAS = [
+    "PRAGMA journal_mode=WAL;",
+]
+# Per-connection settings, applied to every connection when it is opened.
+# NORMAL sync is safe under WAL and drops an fsync per commit.
+CONNECTION_PRAGMAS = [
+    "PRAGMA synchronous=NORMAL;",
+    "PRAGMA temp_store=MEMORY;",
+    "PRAGMA cache_size=-64000;",
+    "PRAGMA mmap_size=268435456;",
+    "PRAGMA busy_timeout=5000;",
+]
+
+# TikTok stats keys that the pipeline reads, stored as real columns: {column: stats key}
+STAT_COLUMNS = {
+    "play_count": "playCount",
+    "digg_count": "diggCount",
+    "comment_count": "commentCount",
+    "share_count": "shareCount",
+}
+
+def dict_factory(cursor, row) -> Dict[str, Any]:
+    """Row factory that builds plain dicts directly, skipping the Row -> dict copy."""
+    return dict(zip([column[0] for column in cursor.description], row))
+
+async def open_connection(read_only: bool = False) -> aiosqlite.Connection:
+    """Opens an aiosqlite connection to DB_PATH with the per-connection pragmas applied."""
+    if read_only:
+        conn = await aiosqlite.connect(f"file:{DB_PATH}?mode=ro", uri=True)
+    else:
+        conn = await aiosqlite.connect(DB_PATH)
+    conn.row_factory = dict_factory
+    for pragma in CONNECTION_PRAGMAS:
+        await conn.execute(pragma)
+    return conn
+
+def set_db_connection(conn: Optional[aiosqlite.Connection]):
+    """Registers the shared read-write aiosqlite connection used by get_db()."""
+    global _db
+    _db = conn
+
+def set_read_connections(conns: List[aiosqlite.Connection]):
+    """Registers the read-only connections handed out by get_db_ro()."""
+    global _read_pool
+    if not conns:
+        _read_pool = None
+        return
+    _read_pool = asyncio.Queue()
+    for conn in conns:
+        _read_pool.put_nowait(conn)
+
 @asynccontextmanager
 async def get_db():
-    """Async context manager for aiosqlite connection."""
-    conn = await aiosqlite.connect(DB_PATH)
-    conn.row_factory = aiosqlite.Row
-    await conn.execute("PRAGMA journal_mode=WAL;")
+    """
+    Async context manager yielding the shared read-write connection.
+    Writers are serialized with a lock so one task's transaction is never
+    committed or rolled back by another.
+    """
+    if _db is None:
+        raise RuntimeError("Database connection has not been initialized.")
+    async with _write_lock:
+        try:
+            yield _db
+            await _db.commit()
+        except BaseException:
+            # BaseException so a cancelled writer (e.g. a paused workflow step) can't leave
+            # its half-finished transaction open for the next writer's commit. Shielded so
+            # a second cancellation still queues the rollback before the lock is released.
+            await asyncio.shield(_db.rollback())
+            raise
+
+async def discard_pending_writes() -> bool:
+    """
+    Rolls back any transaction still open on the shared writer, e.g. after a
+    cancelled task. Returns True if there was one to discard.
+    """
+    async with _write_lock:
+        if _db is not None and _db.in_transaction:
+            await _db.rollback()
+            return True
+        return False
+
+@asynccontextmanager
+async def get_db_ro():
+    """Async context manager that borrows a read-only connection from the pool."""
+    if _read_pool is None:
+        raise RuntimeError("Read connections have not been initialized.")
+    conn = await _read_pool.get()
     try:
         yield conn
-        await conn.commit()
-    except Exception as e:
-        await conn.rollback()
-        raise
     finally:
-        await conn.close()
+        _read_pool.put_nowait(conn)
 
 
 async def initialize_database():
-    """Creates all necessary tables if they don't exist."""
-    async with get_db() as db:        
+    """
+    Creates all necessary tables if they don't exist. Tables are STRICT, so booleans
+    are stored as INTEGER 0/1 (databases created before this keep their old schema).
+    """
+    async with get_db() as db:
+        for pragma in DATABASE_PRAGMAS:
+            await db.execute(pragma)
+
         # Projects table
         await db.execute("""
             CREATE TABLE IF NOT EXISTS projects (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 name TEXT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                is_paused BOOLEAN DEFAULT FALSE,
+                created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+                is_paused INTEGER DEFAULT 0,
                 channel_description TEXT
-            )
+            ) STRICT
         """)
 
         # Trends chosen for a project
@@ -49,9 +149,9 @@ async def initialize_database():
                 keyword TEXT NOT NULL,
                 justification TEXT,
                 suggested_video_title TEXT,
-                long_term_potential BOOLEAN,
+                long_term_potential INTEGER,
                 FOREIGN KEY (project_id) REFERENCES projects (id)
-            )
+            ) STRICT
         """)
 
         # Main table to track videos through the pipeline
@@ -68,26 +168,62 @@ async def initialize_database():
                 description TEXT,
                 video_url TEXT,
                 cover_url TEXT,
-                stats TEXT, -- Stored as JSON string
+                stats TEXT, -- Full stats payload as JSON string
+                play_count INTEGER,
+                digg_count INTEGER,
+                comment_count INTEGER,
+                share_count INTEGER,
                 
                 -- Analysis Data --
                 sentiment_compound_score REAL,
                 sentiment_polarity TEXT,
                 emotion TEXT,
                 engagement_score REAL,
-                is_top_pick BOOLEAN DEFAULT FALSE,
+                is_top_pick INTEGER DEFAULT 0,
                 
                 -- Content Generation Data --
                 generated_script TEXT,
                 local_file_path TEXT,
 
                 FOREIGN KEY (project_id) REFERENCES projects (id)
-            )
+            ) STRICT
+        """)
+
+        await _add_missing_stat_columns(db)
+
+        # Indexes for the pipeline's hot WHERE clauses. The partial indexes mirror the
+        # exact predicates used by the analysis and commentary queries below.
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_videos_project ON videos(project_id)")
+        await db.execute("""
+            CREATE INDEX IF NOT EXISTS idx_videos_proj_analysis ON videos(project_id)
+            WHERE sentiment_compound_score IS NULL
+        """)
+        await db.execute("""
+            CREATE INDEX IF NOT EXISTS idx_videos_proj_top ON videos(project_id)
+            WHERE is_top_pick = 1 AND generated_script IS NULL
         """)
-        
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_trends_proj ON trends(project_id)")
+
         await db.commit()
         logger.info("Database initialized successfully.")
 
+async def _add_missing_stat_columns(db: aiosqlite.Connection):
+    """Adds the numeric stats columns to databases created before they existed and backfills them."""
+    cursor = await db.execute("PRAGMA table_info(videos)")
+    existing = {row['name'] for row in await cursor.fetchall()}
+    for column, stats_key in STAT_COLUMNS.items():
+        if column not in existing:
+            await db.execute(f"ALTER TABLE videos ADD COLUMN {column} INTEGER")
+            await db.execute(
+                f"UPDATE videos SET {column} = json_extract(stats, '$.{stats_key}') WHERE stats IS NOT NULL"
+            )
+            logger.info("Added and backfilled videos.%s.", column)
+
+async def optimize_database():
+    """Runs PRAGMA optimize so SQLite can refresh query planner statistics."""
+    async with get_db() as db:
+        await db.execute("PRAGMA optimize;")
+
 # --- Project Management ---
 async def create_project(name: str, description: str) -> int:
     """Creates a new project and returns its ID."""
@@ -97,135 +233,189 @@ async def create_project(name: str, description: str) -> int:
             (name, description)
         )
         await db.commit()
-        logger.info(f"Created new project '{name}' with ID {cursor.lastrowid}")
+        logger.info("Created new project '%s' with ID %s", name, cursor.lastrowid)
         return cursor.lastrowid
 
 async def get_project(project_id: int) -> Optional[Dict]:
     """Retrieves a single project from the database."""
-    async with get_db() as db:
-        cursor = await db.execute("SELECT * FROM projects WHERE id = ?", (project_id,))
-        row = await cursor.fetchone()
-        return dict(row) if row else None
+    async with get_db_ro() as db:
+        async with db.execute("SELECT * FROM projects WHERE id = ?", (project_id,)) as cursor:
+            row = await cursor.fetchone()
+        return row
 
 
 async def get_all_projects() -> List[Dict]:
     """Retrieves all projects from the database."""
-    async with get_db() as db:
+    async with get_db_ro() as db:
         cursor = await db.execute("SELECT id, name, created_at, channel_description FROM projects ORDER BY created_at DESC")
-        rows = await cursor.fetchall()
-        return [dict(row) for row in rows]
+        return await cursor.fetchall()
 
 async def toggle_project_pause(project_id: int, is_paused: bool) -> bool:
     """Sets the pause state for a project."""
     async with get_db() as db:
-        await db.execute("UPDATE projects SET is_paused = ? WHERE id = ?", (is_paused, project_id))
+        await db.execute("UPDATE projects SET is_paused = ? WHERE id = ?", (int(is_paused), project_id))
         await db.commit()
-        logger.info(f"Project {project_id} pause state set to {is_paused}")
+        logger.info("Project %s pause state set to %s", project_id, is_paused)
         return True
 
 async def is_project_paused(project_id: int) -> bool:
     """Checks if a project is currently paused."""
-    async with get_db() as db:
-        cursor = await db.execute("SELECT is_paused FROM projects WHERE id = ?", (project_id,))
-        row = await cursor.fetchone()
+    async with get_db_ro() as db:
+        async with db.execute("SELECT is_paused FROM projects WHERE id = ?", (project_id,)) as cursor:
+            row = await cursor.fetchone()
         return row['is_paused'] if row else True # Default to paused if project not found
 
 
 # --- Data Persistence for Each Step ---
 
+# SQLite's default maximum number of bound parameters per statement
+SQLITE_MAX_VARIABLES = 999
+
+# Bulk write statements are defined once so every call reuses the same SQL text,
+# which keeps them hitting sqlite3's per-connection prepared statement cache.
+_INSERT_TRENDS_SQL = """
+    INSERT INTO trends (project_id, keyword, justification, suggested_video_title, long_term_potential)
+"""
+_INSERT_VIDEOS_SQL = """
+    INSERT OR IGNORE INTO videos (
+        project_id, trend_keyword, video_id, author_username, create_time,
+        description, video_url, cover_url, stats,
+        play_count, digg_count, comment_count, share_count
+    )
+"""
+_UPDATE_VIDEO_ANALYSIS_SQL = """
+    UPDATE videos SET
+        sentiment_compound_score = ?,
+        sentiment_polarity = ?,
+        emotion = ?,
+        engagement_score = ?,
+        is_top_pick = ?
+    WHERE id = ?
+"""
+
+@lru_cache(maxsize=128)
+def _multi_row_insert_sql(insert_sql: str, cols: int, n_rows: int) -> str:
+    """Builds (and memoizes) an INSERT with n_rows placeholder groups of cols values each."""
+    row_placeholder = "(" + ",".join("?" * cols) + ")"
+    return f"{insert_sql} VALUES {','.join([row_placeholder] * n_rows)}"
+
+async def _insert_many(db: aiosqlite.Connection, insert_sql: str, rows: List[tuple]) -> int:
+    """
+    Inserts rows with multi-row "INSERT ... VALUES (...), (...)" statements, chunked to
+    stay under SQLite's bound-parameter limit. Returns the number of rows inserted.
+    """
+    if not rows:
+        return 0
+    cols = len(rows[0])
+    chunk_size = SQLITE_MAX_VARIABLES // cols
+    inserted = 0
+    for start in range(0, len(rows), chunk_size):
+        chunk = rows[start:start + chunk_size]
+        sql = _multi_row_insert_sql(insert_sql, cols, len(chunk))
+        cursor = await db.execute(sql, list(itertools.chain.from_iterable(chunk)))
+        inserted += max(cursor.rowcount, 0)
+    return inserted
+
 async def save_trends_to_db(project_id: int, trends: List[Dict]):
     """Saves the selected trends from the LLM to the database."""
+    rows = [
+        (
+            project_id, trend['keyword'], trend['justification'],
+            trend['suggested_video_title'], int(trend['long_term_potential'])
+        )
+        for trend in trends
+    ]
     async with get_db() as db:
-        for trend in trends:
-            await db.execute("""
-                INSERT INTO trends (project_id, keyword, justification, suggested_video_title, long_term_potential)
-                VALUES (?, ?, ?, ?, ?)
-            """, (
-                project_id, trend['keyword'], trend['justification'], 
-                trend['suggested_video_title'], trend['long_term_potential']
-            ))
+        # Multi-row inserts inside a single transaction instead of a round-trip per row
+        await _insert_many(db, _INSERT_TRENDS_SQL, rows)
         await db.commit()
-        logger.info(f"Saved {len(trends)} trends to the database for project {project_id}.")
+        logger.info("Saved %s trends to the database for project %s.", len(trends), project_id)
+
+async def _existing_video_ids(db: aiosqlite.Connection, video_ids: List[str]) -> set:
+    """Returns the subset of video_ids already stored, querying in parameter-limit sized chunks."""
+    existing = set()
+    for start in range(0, len(video_ids), SQLITE_MAX_VARIABLES):
+        chunk = video_ids[start:start + SQLITE_MAX_VARIABLES]
+        async with db.execute(
+            f"SELECT video_id FROM videos WHERE video_id IN ({','.join('?' * len(chunk))})", chunk
+        ) as cursor:
+            existing.update(row['video_id'] for row in await cursor.fetchall())
+    return existing
 
 async def save_fetched_videos_to_db(project_id: int, keyword: str, videos: List[Dict]):
     """Saves fetched video data into the main videos table."""
     async with get_db() as db:
-        count = 0
-        for video in videos:
-            # Using INSERT OR IGNORE to prevent duplicates based on the UNIQUE video_id
-            cursor = await db.execute("""
-                INSERT OR IGNORE INTO videos (
-                    project_id, trend_keyword, video_id, author_username, create_time,
-                    description, video_url, cover_url, stats
-                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """, (
+        # Drop videos that are already stored (common when re-fetching trending) so they
+        # cost neither serialization nor a unique-index insert attempt
+        existing = await _existing_video_ids(db, [video['video_id'] for video in videos])
+        rows = [
+            (
                 project_id, keyword, video['video_id'], video['author_username'],
                 video['create_time'], video['description'], video['video_url'],
-                video['cover_url'], json.dumps(video['stats'])
-            ))
-            if cursor.rowcount > 0:
-                count += 1
+                video['cover_url'], orjson.dumps(video['stats']).decode(),
+                *(video['stats'].get(stats_key, 0) for stats_key in STAT_COLUMNS.values())
+            )
+            for video in videos
+            if video['video_id'] not in existing
+        ]
+        # INSERT OR IGNORE still guards against duplicates within the batch itself
+        count = await _insert_many(db, _INSERT_VIDEOS_SQL, rows)
         await db.commit()
-        logger.info(f"Saved {count} new videos to the database for keyword '{keyword}'.")
+        logger.info("Saved %s new videos to the database for keyword '%s'.", count, keyword)
 
-async def get_videos_for_analysis(project_id: int) -> List[Dict]:
-    """Gets videos that have been fetched but not yet analyzed."""
-    async with get_db() as db:
-        cursor = await db.execute(
-            "SELECT * FROM videos WHERE project_id = ? AND sentiment_compound_score IS NULL",
+async def get_videos_for_analysis(project_id: int) -> AsyncIterator[Dict]:
+    """Streams videos that have been fetched but not yet analyzed, one row at a time."""
+    async with get_db_ro() as db:
+        # Only the columns the analyzer reads; stats come from the numeric columns
+        async with db.execute(
+            f"""
+            SELECT id, video_id, {", ".join(STAT_COLUMNS)}
+            FROM videos WHERE project_id = ? AND sentiment_compound_score IS NULL
+            """,
             (project_id,)
-        )
-        rows = await cursor.fetchall()
-        # Deserialize JSON stats field
-        results = []
-        for row in rows:
-            row_dict = dict(row)
-            row_dict['stats'] = json.loads(row_dict.get('stats', '{}'))
-            results.append(row_dict)
-        return results
+        ) as cursor:
+            async for row in cursor:
+                row['stats'] = {
+                    stats_key: row.pop(column) or 0 for column, stats_key in STAT_COLUMNS.items()
+                }
+                yield row
 
 async def update_videos_with_analysis(project_id: int, analyzed_videos: List[Dict], top_video_ids: List[str]):
     """Updates videos with analysis scores and marks the top picks."""
+    top_ids = set(top_video_ids)
+    rows = [
+        (
+            video['analysis']['sentiment']['compound'],
+            video['analysis']['sentiment']['polarity'],
+            video['analysis']['emotion'],
+            video['analysis']['engagement_score'],
+            int(video['video_id'] in top_ids),
+            video['id']
+        )
+        for video in analyzed_videos
+    ]
     async with get_db() as db:
-        for video in analyzed_videos:
-            is_top = video['video_id'] in top_video_ids
-            analysis_data = video['analysis']
-            sentiment_data = analysis_data['sentiment']
-            
-            await db.execute("""
-                UPDATE videos SET
-                    sentiment_compound_score = ?,
-                    sentiment_polarity = ?,
-                    emotion = ?,
-                    engagement_score = ?,
-                    is_top_pick = ?
-                WHERE id = ?
-            """, (
-                sentiment_data['compound'],
-                sentiment_data['polarity'],
-                analysis_data['emotion'],
-                analysis_data['engagement_score'],
-                is_top,
-                video['id']
-            ))
+        # aiosqlite runs the whole executemany in its worker thread: one hop for the batch
+        await db.executemany(_UPDATE_VIDEO_ANALYSIS_SQL, rows)
         await db.commit()
-        logger.info(f"Updated {len(analyzed_videos)} videos with analysis data. Marked {len(top_video_ids)} as top picks.")
+        logger.info("Updated %s videos with analysis data. Marked %s as top picks.", len(analyzed_videos), len(top_video_ids))
 
 
 async def get_top_videos_for_commentary_generation(project_id: int) -> List[Dict]:
     """Gets videos marked as top picks that don't have a script yet."""
-    async with get_db() as db:
+    async with get_db_ro() as db:
+        # Only the columns the commentary generator and the editor summary file use
         cursor = await db.execute(
-            "SELECT * FROM videos WHERE project_id = ? AND is_top_pick = TRUE AND generated_script IS NULL",
+            """
+            SELECT id, video_id, author_username, description, video_url, cover_url, stats
+            FROM videos WHERE project_id = ? AND is_top_pick = 1 AND generated_script IS NULL
+            """,
             (project_id,)
         )
         rows = await cursor.fetchall()
-        results = []
         for row in rows:
-            row_dict = dict(row)
-            row_dict['stats'] = json.loads(row_dict.get('stats', '{}'))
-            results.append(row_dict)
-        return results
+            row['stats'] = orjson.loads(row['stats']) if row['stats'] else {}
+        return rows
 
 async def update_video_with_generated_commentary(video_db_id: int, script: Optional[str], file_path: Optional[str]):
     """Updates a video record with its generated script and local file path."""
@@ -237,32 +427,51 @@ async def update_video_with_generated_commentary(video_db_id: int, script: Optio
         await db.commit()
 
 # --- UI Data Retrieval ---
-async def get_project_summary(project_id: int) -> Dict[str, Any]:
-    """Retrieves a full summary of a project's state for the UI."""
-    summary = {
-        "trends": [],
-        "fetched_videos": [],
-        "top_videos": []
-    }
-    async with get_db() as db:
-        # Get trends
-        trends_cursor = await db.execute("SELECT * FROM trends WHERE project_id = ?", (project_id,))
-        summary['trends'] = [dict(row) for row in await trends_cursor.fetchall()]
-        
-        # Get all videos for the project
-        videos_cursor = await db.execute("SELECT * FROM videos WHERE project_id = ?", (project_id,))
-        all_videos = [dict(row) for row in await videos_cursor.fetchall()]
-
-        for video in all_videos:
-            if video.get('stats'): # Deserialize stats
-                video['stats'] = json.loads(video['stats'])
+TREND_COLUMNS = (
+    "id", "project_id", "keyword", "justification", "suggested_video_title", "long_term_potential"
+)
+VIDEO_COLUMNS = (
+    "id", "project_id", "trend_keyword", "video_id", "author_username", "create_time",
+    "description", "video_url", "cover_url", "stats", *STAT_COLUMNS, "sentiment_compound_score",
+    "sentiment_polarity", "emotion", "engagement_score", "is_top_pick",
+    "generated_script", "local_file_path"
+)
 
-            if video['is_top_pick']:
-                summary['top_videos'].append(video)
-            else:
-                 summary['fetched_videos'].append(video)
+def _json_object_sql(columns: tuple, json_columns: tuple = ()) -> str:
+    """Builds a SQLite json_object(...) expression over the given columns."""
+    pairs = ", ".join(
+        f"'{col}', json({col})" if col in json_columns else f"'{col}', {col}"
+        for col in columns
+    )
+    return f"json_object({pairs})"
 
-    return summary
+_TREND_JSON = _json_object_sql(TREND_COLUMNS)
+_VIDEO_JSON = _json_object_sql(VIDEO_COLUMNS, json_columns=("stats",))
 
+# Aggregates trends and both video groups into JSON arrays server-side, in one query
+_PROJECT_SUMMARY_SQL = f"""
+    SELECT
+        EXISTS (SELECT 1 FROM projects WHERE id = ?) AS project_exists,
+        (SELECT json_group_array({_TREND_JSON}) FROM trends WHERE project_id = ?) AS trends,
+        json_group_array({_VIDEO_JSON}) FILTER (WHERE NOT IFNULL(is_top_pick, 0)) AS fetched_videos,
+        json_group_array({_VIDEO_JSON}) FILTER (WHERE is_top_pick) AS top_videos
+    FROM videos
+    WHERE project_id = ?
+"""
 
+async def get_project_summary(project_id: int) -> Optional[Dict[str, Any]]:
+    """
+    Retrieves a full summary of a project's state for the UI.
+    Returns None if the project does not exist.
+    """
+    async with get_db_ro() as db:
+        async with db.execute(_PROJECT_SUMMARY_SQL, (project_id, project_id, project_id)) as cursor:
+            row = await cursor.fetchone()
 
+    if not row['project_exists']:
+        return None
+    return {
+        "trends": orjson.loads(row['trends']),
+        "fetched_videos": orjson.loads(row['fetched_videos']),
+        "top_videos": orjson.loads(row['top_videos'])
+    }
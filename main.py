@@ -3,8 +3,8 @@
 import os
 import asyncio
 import logging
-import logging.handlers
-import json
+import logging.config
+import orjson
 import sys
 from contextlib import asynccontextmanager
 from functools import lru_cache
@@ -27,18 +27,32 @@ from video_commentary import CommentaryGenerator
 
 
 # --- Logging Setup ---
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+# Configured once here for every module; the other modules only call getLogger(__name__)
+logging.config.dictConfig({
+    "version": 1,
+    "disable_existing_loggers": False,
+    "formatters": {
+        "default": {"format": "%(asctime)s - %(name)s - %(levelname)s - %(message)s"},
+    },
+    "handlers": {
+        "console": {"class": "logging.StreamHandler", "formatter": "default"},
+    },
+    "root": {"level": "INFO", "handlers": ["console"]},
+    "loggers": {__name__: {"level": "DEBUG"}},
+})
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.DEBUG)
 
 # --- App Setup ---
 load_dotenv()
 
 # --- Configuration Loader ---
+# Prefer the libyaml C loader; fall back to the pure-Python one if PyYAML was built without it
+YamlLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
 @lru_cache()
 def get_config():
     with open("config.yaml", "r") as f:
-        return yaml.safe_load(f)
+        return yaml.load(f, Loader=YamlLoader)
 
 # --- Platform-Specific Asyncio Policy ---
 # This is the fix for the NotImplementedError on Windows
@@ -55,36 +69,94 @@ class ConnectionManager:
         self.active_connections.append(websocket)
 
     def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
+        if websocket in self.active_connections:
+            self.active_connections.remove(websocket)
 
     async def broadcast(self, message: str):
-        for connection in self.active_connections:
-            await connection.send_text(message)
+        # Send to all sockets concurrently so one slow client doesn't hold up the rest
+        connections = list(self.active_connections)
+        results = await asyncio.gather(
+            *(connection.send_text(message) for connection in connections),
+            return_exceptions=True
+        )
+        for connection, result in zip(connections, results):
+            if isinstance(result, Exception):
+                logger.info("Dropping WebSocket client after failed send: %r", result)
+                self.disconnect(connection)
 
     async def broadcast_json(self, data: dict):
-        await self.broadcast(json.dumps(data))
+        # Serialized once and shared by every socket
+        await self.broadcast(orjson.dumps(data).decode())
 
 manager = ConnectionManager()
 
+# --- Workflow Pause Signals ---
+# Set by the /pause endpoint so running workflows react immediately instead of polling the DB
+paused_events: dict[int, asyncio.Event] = {}
+
+def get_pause_event(project_id: int) -> asyncio.Event:
+    if project_id not in paused_events:
+        paused_events[project_id] = asyncio.Event()
+    return paused_events[project_id]
+
 # --- Shared API Clients / Dependency Injection ---
 shared_clients = {}
 
+DB_OPTIMIZE_INTERVAL_SECONDS = 15 * 60
+
+async def optimize_database_periodically():
+    while True:
+        await asyncio.sleep(DB_OPTIMIZE_INTERVAL_SECONDS)
+        try:
+            await database.optimize_database()
+        except Exception as e:
+            logger.error("PRAGMA optimize failed: %s", e)
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # On startup
-    await database.initialize_database()
-    ms_token = os.getenv("MS_TOKEN")
-    if not ms_token:
-        logger.warning("MS_TOKEN environment variable not set. TikTokApi may be unreliable or fail.")
-    
-    # Create a single, shared TikTokApi instance
-    shared_clients["tiktok_api"] = TikTokApi()
-    await shared_clients["tiktok_api"].create_sessions(ms_tokens=[ms_token], num_sessions=1, sleep_after=3)
-    yield
-    # On shutdown
-    logger.info("Application shutting down.")
-    if "tiktok_api" in shared_clients:
-        await shared_clients["tiktok_api"].close_sessions()
+    # Open the long-lived database connections shared by every request:
+    # a single writer plus a pool of read-only connections for SELECTs
+    shared_clients["db_rw"] = await database.open_connection()
+    shared_clients["db_ro"] = []
+    optimize_task = None
+    try:
+        database.set_db_connection(shared_clients["db_rw"])
+        await database.initialize_database()
+        for _ in range(database.READ_POOL_SIZE):
+            shared_clients["db_ro"].append(await database.open_connection(read_only=True))
+        database.set_read_connections(shared_clients["db_ro"])
+        optimize_task = asyncio.create_task(optimize_database_periodically())
+
+        ms_token = os.getenv("MS_TOKEN")
+        if not ms_token:
+            logger.warning("MS_TOKEN environment variable not set. TikTokApi may be unreliable or fail.")
+        
+        # Create a single, shared TikTokApi instance
+        shared_clients["tiktok_api"] = TikTokApi()
+        await shared_clients["tiktok_api"].create_sessions(ms_tokens=[ms_token], num_sessions=1, sleep_after=3)
+
+        # Build the default Gemini client up front when a key is configured
+        if os.getenv("GEMINI_API_KEY"):
+            shared_clients["gemini_default"] = get_gemini_client()
+        yield
+    finally:
+        # On shutdown (or failed startup); the aiosqlite connections must always be
+        # closed, as their worker threads would otherwise keep the process alive
+        logger.info("Application shutting down.")
+        if optimize_task is not None:
+            optimize_task.cancel()
+        try:
+            if "tiktok_api" in shared_clients:
+                await shared_clients.pop("tiktok_api").close_sessions()
+        except Exception as e:
+            logger.error("Failed to close TikTokApi sessions: %s", e)
+        finally:
+            database.set_read_connections([])
+            for conn in shared_clients.pop("db_ro"):
+                await conn.close()
+            database.set_db_connection(None)
+            await shared_clients.pop("db_rw").close()
 
 
 app = FastAPI(lifespan=lifespan)
@@ -94,11 +166,16 @@ app.mount("/static", StaticFiles(directory="."), name="static")
 def get_tiktok_api():
     return shared_clients["tiktok_api"]
 
+@lru_cache(maxsize=8)
+def _create_gemini_client(api_key: str) -> genai.Client:
+    # Clients are reused for the life of the process so their HTTP pools stay warm
+    return genai.Client(api_key=api_key)
+
 def get_gemini_client(api_key: str | None = None):
     key = api_key or os.getenv("GEMINI_API_KEY")
     if not key:
         raise HTTPException(status_code=400, detail="GEMINI_API_KEY not provided.")
-    return genai.Client(api_key=key)
+    return _create_gemini_client(key)
 
 # --- Pydantic Models for API ---
 class ProjectCreate(BaseModel):
@@ -151,15 +228,18 @@ async def create_project_endpoint(project: ProjectCreate):
 @app.get("/projects/{project_id}/summary")
 async def get_project_summary(project_id: int):
     summary = await database.get_project_summary(project_id)
-    if not any(summary.values()): # Check if all lists are empty
-        project_exists = await database.get_project(project_id)
-        if not project_exists:
-             raise HTTPException(status_code=404, detail="Project not found")
+    if summary is None:
+        raise HTTPException(status_code=404, detail="Project not found")
     return summary
     
 @app.post("/projects/{project_id}/pause")
 async def toggle_pause(project_id: int, payload: TogglePausePayload):
     await database.toggle_project_pause(project_id, payload.is_paused)
+    pause_event = get_pause_event(project_id)
+    if payload.is_paused:
+        pause_event.set()
+    else:
+        pause_event.clear()
     status = "paused" if payload.is_paused else "resumed"
     await log_and_broadcast(f"Project {project_id} has been {status}.")
     return {"message": f"Project {project_id} state set to {status}."}
@@ -223,31 +303,24 @@ async def run_analyze_task(project_id: int, payload: RunPayload, config: dict, t
     await broadcast_status("analyze", "running", project_id)
     analyzer = VideoAnalyzer(tiktok_api=tiktok_api, config=config)
     
-    videos_to_analyze = await database.get_videos_for_analysis(project_id)
-    if not videos_to_analyze:
+    await log_and_broadcast("Starting analysis of newly fetched videos...")
+    top_videos, all_analyzed_videos = await analyzer.analyze_and_filter_videos_concurrently(
+        database.get_videos_for_analysis(project_id)
+    )
+    if not all_analyzed_videos:
         await log_and_broadcast("No new videos to analyze.")
         await broadcast_status("analyze", "complete", project_id)
         return
 
-    await log_and_broadcast(f"Starting analysis for {len(videos_to_analyze)} videos...")
-    top_videos, all_analyzed_videos = await analyzer.analyze_and_filter_videos_concurrently(videos_to_analyze)
-    
-    if all_analyzed_videos:
-        await database.update_videos_with_analysis(
-            project_id, all_analyzed_videos, [v['video_id'] for v in top_videos]
-        )
-    await log_and_broadcast("Video analysis and curation complete.")
+    await database.update_videos_with_analysis(
+        project_id, all_analyzed_videos, [v['video_id'] for v in top_videos]
+    )
+    await log_and_broadcast(f"Video analysis and curation complete for {len(all_analyzed_videos)} videos.")
     await broadcast_status("analyze", "complete", project_id)
 
 
 async def run_generate_task(project_id: int, payload: RunPayload, config: dict, tiktok_api: TikTokApi):
     await broadcast_status("generate", "running", project_id)
-    generator = CommentaryGenerator(
-        gemini_client=get_gemini_client(payload.gemini_api_key),
-        tiktok_api=tiktok_api,
-        config=config
-    )
-
     videos_to_process = await database.get_top_videos_for_commentary_generation(project_id)
     if not videos_to_process:
         await log_and_broadcast("No top videos ready for content generation.")
@@ -255,7 +328,12 @@ async def run_generate_task(project_id: int, payload: RunPayload, config: dict,
         return
 
     await log_and_broadcast(f"Starting content generation for {len(videos_to_process)} videos...")
-    processed_videos = await generator.process_project_videos_concurrently(project_id, videos_to_process)
+    async with CommentaryGenerator(
+        gemini_client=get_gemini_client(payload.gemini_api_key),
+        tiktok_api=tiktok_api,
+        config=config
+    ) as generator:
+        processed_videos = await generator.process_project_videos_concurrently(project_id, videos_to_process)
     
     for video_data in processed_videos:
         await database.update_video_with_generated_commentary(
@@ -309,18 +387,43 @@ async def run_all_steps(project_id: int, payload: RunPayload,
             (run_analyze_task, "analyze"),
             (run_generate_task, "generate")
         ]
+
+        async def halt(name: str):
+            await log_and_broadcast(f"Workflow for project {project_id} is paused. Halting execution.", type="log")
+            await broadcast_status(name, "paused", project_id)
+
         try:
+            # The stored flag is the source of truth (e.g. after a restart); sync the event once per run
+            pause_event = get_pause_event(project_id)
+            if await database.is_project_paused(project_id):
+                pause_event.set()
+            else:
+                pause_event.clear()
+
             for task_func, name in steps:
-                if await database.is_project_paused(project_id):
-                    await log_and_broadcast(f"Workflow for project {project_id} is paused. Halting execution.", type="log")
-                    await broadcast_status(name, "paused", project_id)
+                if pause_event.is_set():
+                    await halt(name)
                     return
-                
+
                 task_args = (project_id, payload, config)
                 if name in ["fetch", "analyze", "generate"]:
                     task_args += (tiktok_api,)
 
-                await task_func(*task_args)
+                # Race the step against the pause signal; pausing cancels the running step
+                step_task = asyncio.create_task(task_func(*task_args))
+                pause_wait = asyncio.create_task(pause_event.wait())
+                done, _ = await asyncio.wait({step_task, pause_wait}, return_when=asyncio.FIRST_COMPLETED)
+                pause_wait.cancel()
+                if step_task not in done:
+                    step_task.cancel()
+                    await asyncio.gather(step_task, return_exceptions=True)
+                    # get_db rolls back cancelled writers; confirm the step left nothing
+                    # behind for the next write (e.g. the un-pause) to commit
+                    if await database.discard_pending_writes():
+                        logger.warning("Paused '%s' step left an open transaction; rolled it back.", name)
+                    await halt(name)
+                    return
+                step_task.result()
                 await asyncio.sleep(1) 
 
             await log_and_broadcast("Full workflow completed successfully!")
@@ -347,7 +450,7 @@ async def websocket_endpoint(websocket: WebSocket):
 
 # --- Uvicorn Runner ---
 if __name__ == "__main__":
-    logger.info(f"--- Script Starting --- \nPython {sys.version} \n-----------------------------")
-    logger.info(f"Starting Uvicorn server on host 0.0.0.0, port 8000")
+    logger.info("--- Script Starting --- \nPython %s \n-----------------------------", sys.version)
+    logger.info("Starting Uvicorn server on host 0.0.0.0, port 8000")
     import uvicorn
     uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=False)
\ No newline at end of file
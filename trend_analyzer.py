@@ -21,41 +21,53 @@ class SelectedTrends(BaseModel):
     selected_trends: List[Trend] = Field(description="A list of the best trends to create a YouTube video on.")
 
 # --- Logging Setup ---
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Shared across analyzers: TrendReq fetches a Google cookie when it is constructed
+_pytrends: Optional[TrendReq] = None
+
+def get_pytrends() -> TrendReq:
+    """Returns the process-wide pytrends client, creating it on first use."""
+    global _pytrends
+    if _pytrends is None:
+        _pytrends = TrendReq(hl='en-US', tz=360)
+    return _pytrends
+
 class TrendAnalyzer:
     """
     Fetches trending topics from Google Trends and uses an LLM to select the most
     relevant ones for a specific YouTube channel.
     """
     def __init__(self, gemini_client: genai.Client, config: dict):
-        self.pytrends = TrendReq(hl='en-US', tz=360)
+        self.pytrends = get_pytrends()
         self.client = gemini_client
         self.model = config['gemini_model']
         self.config = config.get('prompts', {}).get('trend_selection', {})
 
+    def _fetch_daily(self) -> List[str]:
+        return self.pytrends.trending_searches(pn='united_states').iloc[:, 0].tolist()
+
+    def _fetch_realtime(self) -> List[str]:
+        return self.pytrends.realtime_trending_searches(count=20, category='all', pn='US')['title'].tolist()
+
     @retry(wait=wait_exponential(multiplier=1, max=10), stop=stop_after_attempt(3))
     async def get_google_trends(self) -> List[str]:
         """
-        Fetches top trends. Uses asyncio.to_thread to run the blocking
-        pytrends library in a non-blocking way. Retries on failure.
+        Fetches top trends. The daily and realtime lookups run concurrently in
+        worker threads so the blocking pytrends calls overlap. Retries on failure.
         """
-        loop = asyncio.get_running_loop()
-        
-        def fetch_trends():
-            try:
-                logger.info("Fetching Google Trends data...")
-                daily = self.pytrends.trending_searches(pn='united_states').iloc[:, 0].tolist()
-                realtime = self.pytrends.realtime_trending_searches(count=20, category='all', pn='US')['title'].tolist()
-                combined = list(dict.fromkeys(daily + realtime))
-                logger.info(f"Found {len(combined)} unique trends.")
-                return combined
-            except Exception as e:
-                logger.error(f"Failed to fetch Google Trends: {e}")
-                raise # Reraise to trigger tenacity retry
-
-        return await loop.run_in_executor(None, fetch_trends)
+        try:
+            logger.info("Fetching Google Trends data...")
+            daily, realtime = await asyncio.gather(
+                asyncio.to_thread(self._fetch_daily),
+                asyncio.to_thread(self._fetch_realtime)
+            )
+            combined = list(dict.fromkeys(daily + realtime))
+            logger.info("Found %s unique trends.", len(combined))
+            return combined
+        except Exception as e:
+            logger.error("Failed to fetch Google Trends: %s", e)
+            raise # Reraise to trigger tenacity retry
 
     @retry(wait=wait_exponential(multiplier=1, max=10), stop=stop_after_attempt(3))
     async def select_best_trends(self, trends: List[str], channel_description: str) -> Optional[dict]:
@@ -70,19 +82,26 @@ class TrendAnalyzer:
         
         logger.info("Asking LLM to select the best trends...")
         try:
-            gen_config = {'response_mime_type': 'application/json', 'response_schema': SelectedTrends}
-            response = self.client.generate_content(
+            gen_config = {
+                'response_mime_type': 'application/json',
+                'response_schema': SelectedTrends,
+                'system_instruction': self.config.get('system_instruction'),
+            }
+            response = await self.client.aio.models.generate_content(
                 model=self.model,
                 contents=prompt,
-                generation_config=gen_config,
-                system_instruction=self.config.get('system_instruction')
+                config=gen_config
             )
             
-            response_json = json.loads(response.text)
+            # The SDK validates the response against response_schema; parse by hand only if it couldn't
+            if isinstance(response.parsed, SelectedTrends):
+                response_json = response.parsed.model_dump()
+            else:
+                response_json = json.loads(response.text)
             logger.info("Successfully received and parsed LLM response for trend selection.")
             return response_json
 
         except Exception as e:
-            logger.error(f"An error occurred during LLM trend selection: {e}")
+            logger.error("An error occurred during LLM trend selection: %s", e)
             raise # Reraise to trigger tenacity retry
 
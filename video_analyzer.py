@@ -1,34 +1,139 @@
 # video_analyzer.py
 
+import os
+import re
+import importlib.util
+import sys
+import heapq
 import asyncio
 import logging
-from typing import List, Dict, Optional, Tuple
-from concurrent.futures import ProcessPoolExecutor
+import xml.etree.ElementTree as ElementTree
+from collections import Counter, defaultdict
+from functools import lru_cache
+from pathlib import Path
+from statistics import fmean
+from typing import List, Dict, Optional, Tuple, AsyncIterable, Callable
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
 
+import numpy as np
+import orjson
 from TikTokApi import TikTokApi
 from TikTokApi.exceptions import TikTokException
 from tenacity import retry, stop_after_attempt, wait_exponential
-from textblob import TextBlob
-from nrclex import NRCLex
+
+from video_fetcher import get_cached_comments
 
 # --- Logging Setup ---
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-# --- CPU-Bound Analysis Function ---
-# This function is designed to be run in a separate process to avoid blocking asyncio
-def perform_text_analysis(comments: List[str]) -> Tuple[Dict[str, float], str]:
+# --- Sentiment & Emotion Lexicons ---
+# textblob/nrclex are only located here, not imported: the lexicon files are read
+# directly, and importing textblob pulls in nltk. The textblob backend imports them.
+def _package_dir(name: str) -> Path:
+    spec = importlib.util.find_spec(name)
+    if spec is None or spec.origin is None:
+        raise ModuleNotFoundError(f"Package '{name}' is required for its lexicon data", name=name)
+    return Path(spec.origin).parent
+
+_TOKEN_RE = re.compile(r"[A-Za-z']+")
+# Comments without a two-letter word ("🔥🔥", "!!", "k") carry no lexicon signal
+_ALPHA_RE = re.compile(r"[A-Za-z]{2,}")
+_NEGATIONS = frozenset(("no", "not", "never", "n't"))
+# NRC's positive/negative categories are left out as they are covered by sentiment
+NRC_EMOTIONS = ("anger", "anticipation", "disgust", "fear", "joy", "sadness", "surprise", "trust")
+
+# Populated once per process by load_lexicons
+_POLARITY: Dict[str, float] = {}
+# {word: bitmask}, bit i set iff the word is associated with NRC_EMOTIONS[i]
+_NRC_BITS: Dict[str, int] = {}
+_EMOTION_SHIFTS = np.arange(len(NRC_EMOTIONS), dtype=np.uint8)
+# Lexicon words that also negate the next word ("can't", "won't")
+_NEGATING_LEXICON_WORDS: frozenset = frozenset()
+
+def _load_polarity_lexicon() -> Dict[str, float]:
     """
-    Performs sentiment and emotion analysis on a list of comments.
-    This is a CPU-intensive task.
+    Builds {word: polarity} from TextBlob's en-sentiment.xml. Like TextBlob does for
+    untagged text, senses are averaged per part of speech and then across them.
     """
-    # 1. Sentiment Analysis with TextBlob
-    polarity_sum = 0
-    for comment in comments:
-        polarity_sum += TextBlob(comment).sentiment.polarity
-    
-    avg_polarity = polarity_sum / len(comments) if comments else 0
-    
+    path = _package_dir("textblob") / "en" / "en-sentiment.xml"
+    senses = defaultdict(lambda: defaultdict(list))
+    for word in ElementTree.parse(path).getroot().iter("word"):
+        form = word.get("form")
+        if form:
+            senses[form][word.get("pos")].append(float(word.get("polarity", 0.0)))
+    return {
+        form: fmean(fmean(polarities) for polarities in by_pos.values())
+        for form, by_pos in senses.items()
+    }
+
+def _load_nrc_lexicon() -> Dict[str, int]:
+    """Builds {word: emotion bitmask} from the NRC lexicon bundled with nrclex."""
+    package_dir = _package_dir("nrclex")
+    path = next(
+        (p for p in (package_dir / "data" / "nrc_en.json", package_dir / "nrc_en.json") if p.exists()),
+        None,
+    )
+    if path is None:
+        raise FileNotFoundError(f"NRC lexicon nrc_en.json not found under {package_dir}")
+    lexicon = orjson.loads(path.read_bytes())
+    bit_of = {emotion: 1 << i for i, emotion in enumerate(NRC_EMOTIONS)}
+    return {
+        word: bits
+        for word, categories in lexicon.items()
+        if (bits := sum(bit_of.get(category, 0) for category in set(categories)))
+    }
+
+def load_lexicons() -> None:
+    """Parses both lexicons into the module globals; later calls are no-ops."""
+    global _POLARITY, _NRC_BITS, _NEGATING_LEXICON_WORDS
+    if _POLARITY:
+        return
+    _POLARITY = _load_polarity_lexicon()
+    _NEGATING_LEXICON_WORDS = frozenset(filter(_is_negation, _POLARITY))
+    _NRC_BITS = _load_nrc_lexicon()
+
+def _is_negation(token: str) -> bool:
+    return token in _NEGATIONS or token.endswith("n't")
+
+def tokens_polarity(tokens: Tuple[str, ...]) -> float:
+    """
+    Scores one comment's tokens the way TextBlob's pattern analyzer does, minus POS
+    tagging: the mean polarity of the lexicon words among them, where a negated word
+    ("not good") counts as -0.5x its polarity. Comments without lexicon words score 0.
+    """
+    # Hot loop: one dict lookup per token, with lookups bound to locals
+    polarity_of = _POLARITY.get
+    negating_lexicon_words = _NEGATING_LEXICON_WORDS
+    total, matched, negated = 0.0, 0, False
+    for token in tokens:
+        polarity = polarity_of(token)
+        if polarity is None:
+            if token in _NEGATIONS or token.endswith("n't"):
+                negated = True
+            elif negated and len(token.strip("'")) > 1:
+                # Negation carries across short words only ("not a good")
+                negated = False
+            continue
+        total += polarity * -0.5 if negated else polarity
+        matched += 1
+        negated = token in negating_lexicon_words
+    return total / matched if matched else 0.0
+
+@lru_cache(maxsize=8192)
+def analyze_comment(comment: str) -> Tuple[float, Tuple[str, ...]]:
+    """
+    Returns (polarity, tokens) for one comment. Memoized per worker process, since
+    short comments ("lol", "first", "🔥🔥") repeat across videos; tokens are interned
+    so repeated words share one string object in the counts.
+    """
+    tokens = tuple(map(sys.intern, _TOKEN_RE.findall(comment.lower())))
+    return tokens_polarity(tokens), tokens
+
+def _with_words(comments: List[str]) -> List[str]:
+    """Drops emoji-only and one-letter comments, which would only dilute the average."""
+    return [comment for comment in comments if _ALPHA_RE.search(comment)]
+
+def _sentiment_results(avg_polarity: float) -> Dict[str, float]:
     if avg_polarity > 0.1:
         sentiment_label = "Positive"
     elif avg_polarity < -0.1:
@@ -36,21 +141,79 @@ def perform_text_analysis(comments: List[str]) -> Tuple[Dict[str, float], str]:
     else:
         sentiment_label = "Neutral"
 
-    sentiment_results = {
+    return {
         "compound": avg_polarity,
         "polarity": sentiment_label
     }
 
+# --- Text Analysis Backends ---
+# Both run off the event loop: "fast" on a thread pool, "textblob" in worker processes
+def perform_text_analysis(comments: List[str]) -> Tuple[Dict[str, float], str]:
+    """
+    Performs sentiment and emotion analysis on a list of comments.
+    Sub-millisecond per video with the lexicons loaded by load_lexicons.
+    """
+    comments = _with_words(comments)
+
+    # Tokenize each comment once; the same tokens feed polarity and emotion counts
+    token_counts = Counter()
+    polarities = np.empty(len(comments), dtype=np.float64)
+    for i, comment in enumerate(comments):
+        polarities[i], tokens = analyze_comment(comment)
+        token_counts.update(tokens)
+
+    # 1. Sentiment Analysis with the TextBlob polarity lexicon, averaged over kept comments
+    avg_polarity = float(polarities.mean()) if comments else 0.0
+    sentiment_results = _sentiment_results(avg_polarity)
+
+    # 2. Emotion Analysis with the NRC lexicon: unpack each matched token's bitmask
+    # into an 8-column 0/1 matrix and weight it by the token counts in one matmul
+    bits_of = _NRC_BITS.get
+    matched = [(bits, count) for token, count in token_counts.items() if (bits := bits_of(token))]
+
+    dominant_emotion = "neutral"
+    if matched:
+        bits, counts = np.array(matched, dtype=np.int64).T
+        emotion_totals = counts @ ((bits[:, None] >> _EMOTION_SHIFTS) & 1)
+        dominant_emotion = NRC_EMOTIONS[int(emotion_totals.argmax())]
+
+    return sentiment_results, dominant_emotion
+
+def perform_textblob_analysis(comments: List[str]) -> Tuple[Dict[str, float], str]:
+    """
+    Reference backend: the full TextBlob pattern analyzer per comment and NRCLex over
+    the joined text. This is a CPU-intensive task, so it runs in a separate process.
+    """
+    # Imported here so only processes running this backend load textblob/nltk
+    from textblob import TextBlob
+    from nrclex import NRCLex
+
+    comments = _with_words(comments)
+
+    # 1. Sentiment Analysis with TextBlob
+    polarity_sum = 0
+    for comment in comments:
+        polarity_sum += TextBlob(comment).sentiment.polarity
+    
+    avg_polarity = polarity_sum / max(1, len(comments))
+    sentiment_results = _sentiment_results(avg_polarity)
+
     # 2. Emotion Analysis with NRCLex
     full_text = " ".join(comments)
-    emotion_scores = NRCLex(full_text).raw_emotion_scores
+    if hasattr(NRCLex, 'load_raw_text'):
+        # nrclex 4.x takes a lexicon file in the constructor and loads text separately
+        emotion = NRCLex()
+        emotion.load_raw_text(full_text)
+    else:
+        emotion = NRCLex(full_text)
+    emotion_scores = emotion.raw_emotion_scores
     
-    # Filter out positive/negative as they are covered by sentiment
-    dominant_emotion = "neutral"
-    if emotion_scores:
-        filtered_emotions = {k: v for k, v in emotion_scores.items() if k not in ['positive', 'negative']}
-        if filtered_emotions:
-            dominant_emotion = max(filtered_emotions, key=filtered_emotions.get)
+    # Single-pass argmax, skipping positive/negative as they are covered by sentiment;
+    # ties go to the emotion seen first, as with max()
+    dominant_emotion, best_score = "neutral", 0
+    for emotion, score in emotion_scores.items():
+        if score > best_score and emotion not in ('positive', 'negative'):
+            dominant_emotion, best_score = emotion, score
 
     return sentiment_results, dominant_emotion
 
@@ -65,80 +228,97 @@ class VideoAnalyzer:
         self.TOP_N_VIDEOS = config.get('top_n_videos', 20)
         self.MIN_SENTIMENT_SCORE = config.get('min_sentiment_score', 0.1)
         self.MAX_COMMENTS = config.get('max_comments_for_analysis', 50)
-        # Create a process pool to run CPU-bound tasks
-        self.process_pool = ProcessPoolExecutor()
+        # Bound in-flight comment fetches to avoid TikTok throttling
+        self.comment_semaphore = asyncio.Semaphore(config.get('max_concurrent_comment_fetches', 8))
+        self.max_workers = os.cpu_count() or 1
+        self.executor, self.analyze_comments = self._create_backend(config.get('analysis_backend', 'fast'))
+
+    def _create_backend(self, backend: str) -> Tuple[Executor, Callable[[List[str]], Tuple[Dict[str, float], str]]]:
+        """Returns the executor and analysis function for the configured text analysis backend."""
+        if backend == 'fast':
+            # The lexicon kernel is sub-ms per video, so pickling comments to a
+            # worker process would cost more than the analysis itself
+            load_lexicons()
+            return ThreadPoolExecutor(max_workers=self.max_workers), perform_text_analysis
+        if backend == 'textblob':
+            # TextBlob/NRCLex are CPU-heavy and hold the GIL; run them in processes
+            return ProcessPoolExecutor(max_workers=self.max_workers), perform_textblob_analysis
+        raise ValueError(f"Unknown analysis_backend '{backend}', expected 'fast' or 'textblob'")
 
     @retry(wait=wait_exponential(multiplier=1, max=10), stop=stop_after_attempt(3))
     async def get_comments_for_video(self, video_id: str) -> List[str]:
         """Fetches comments for a single TikTok video with retry logic."""
-        comments_text = []
-        logger.info(f"Fetching up to {self.MAX_COMMENTS} comments for video ID: {video_id}...")
+        logger.info("Fetching up to %s comments for video ID: %s...", self.MAX_COMMENTS, video_id)
         try:
-            video = self.tiktok_api.video(id=video_id)
-            async for comment in video.comments(count=self.MAX_COMMENTS):
-                comments_text.append(comment.text)
-            logger.info(f"Found {len(comments_text)} comments for video {video_id}.")
+            async with self.comment_semaphore:
+                comments_text = await get_cached_comments(self.tiktok_api, video_id, self.MAX_COMMENTS)
+            logger.info("Found %s comments for video %s.", len(comments_text), video_id)
             return comments_text
         except TikTokException as e:
-            logger.error(f"Could not fetch comments for video {video_id}: {e}")
+            logger.error("Could not fetch comments for video %s: %s", video_id, e)
             raise # Reraise for tenacity
         except Exception as e:
-            logger.error(f"An unexpected error occurred fetching comments for {video_id}: {e}")
+            logger.error("An unexpected error occurred fetching comments for %s: %s", video_id, e)
             raise # Reraise for tenacity
 
-    def calculate_engagement_score(self, stats: dict) -> float:
-        """Calculates an engagement score. (likes + comments) / views."""
-        likes = stats.get('diggCount', 0)
-        comments = stats.get('commentCount', 0)
-        views = stats.get('playCount', 0)
-        return (likes + comments) / views if views > 0 else 0.0
+    def calculate_engagement_scores(self, videos: List[Dict]) -> np.ndarray:
+        """Calculates every video's engagement score, (likes + comments) / views, in one vectorized pass."""
+        def stat(key: str) -> np.ndarray:
+            return np.fromiter((v['stats'].get(key, 0) for v in videos), dtype=np.float64, count=len(videos))
 
-    async def analyze_single_video(self, video: dict) -> dict:
-        """Analyzes one video: fetches comments, runs analysis, calculates scores."""
-        comments = await self.get_comments_for_video(video['video_id'])
-        
-        # Offload the CPU-bound analysis to the process pool
-        loop = asyncio.get_running_loop()
-        sentiment_results, emotion = await loop.run_in_executor(
-            self.process_pool, perform_text_analysis, comments
+        views = stat('playCount')
+        return np.divide(
+            stat('diggCount') + stat('commentCount'), views,
+            out=np.zeros(len(videos)), where=views > 0
         )
-        
-        engagement_score = self.calculate_engagement_score(video['stats'])
-        
-        video['analysis'] = {
-            "sentiment": sentiment_results,
-            "emotion": emotion,
-            "engagement_score": engagement_score
-        }
-        return video
-
-    async def analyze_and_filter_videos_concurrently(self, videos_to_analyze: List[Dict]) -> Tuple[List[Dict], List[Dict]]:
+
+    async def _get_indexed_comments(self, index: int, video_id: str) -> Tuple[int, List[str]]:
+        """Tags fetched comments with the video's position so as_completed results can be matched back."""
+        return index, await self.get_comments_for_video(video_id)
+
+    async def analyze_and_filter_videos_concurrently(self, videos_to_analyze: AsyncIterable[Dict]) -> Tuple[List[Dict], List[Dict]]:
         """
         Orchestrates the analysis process for all videos in a project concurrently.
-        Returns (top_videos, all_analyzed_videos).
+        Comment fetches start as videos arrive from the async stream, and each video's
+        comments go to the analysis executor as soon as they are fetched, so the CPU-bound
+        analysis overlaps with the fetches still in flight. Returns (top_videos, all_analyzed_videos).
         """
-        if not videos_to_analyze:
+        analyzed_videos, comment_tasks = [], []
+        async for video in videos_to_analyze:
+            comment_tasks.append(asyncio.create_task(self._get_indexed_comments(len(analyzed_videos), video['video_id'])))
+            analyzed_videos.append(video)
+        if not analyzed_videos:
             return [], []
 
-        # Create a list of analysis tasks to run in parallel
-        tasks = [self.analyze_single_video(video) for video in videos_to_analyze]
-        analyzed_videos = await asyncio.gather(*tasks)
-        
+        # Offload the CPU-bound analysis to the backend's executor in fetch-completion order
+        loop = asyncio.get_running_loop()
+        analysis_futures = [None] * len(analyzed_videos)
+        for next_fetched in asyncio.as_completed(comment_tasks):
+            index, comments = await next_fetched
+            analysis_futures[index] = loop.run_in_executor(self.executor, self.analyze_comments, comments)
+        results = await asyncio.gather(*analysis_futures)
+
+        engagement_scores = self.calculate_engagement_scores(analyzed_videos).tolist()
+        for video, (sentiment_results, emotion), engagement_score in zip(analyzed_videos, results, engagement_scores):
+            video['analysis'] = {
+                "sentiment": sentiment_results,
+                "emotion": emotion,
+                "engagement_score": engagement_score
+            }
+
         # Filter out videos with low sentiment scores
         filtered_videos = [
             v for v in analyzed_videos 
             if v['analysis']['sentiment']['compound'] >= self.MIN_SENTIMENT_SCORE
         ]
         
-        # Sort the remaining videos by engagement score, descending
-        sorted_videos = sorted(
+        # Keep the highest engagement scores, descending, without sorting the whole list
+        top_videos = heapq.nlargest(
+            self.TOP_N_VIDEOS,
             filtered_videos,
-            key=lambda v: v['analysis']['engagement_score'],
-            reverse=True
+            key=lambda v: v['analysis']['engagement_score']
         )
-        
-        top_videos = sorted_videos[:self.TOP_N_VIDEOS]
-        logger.info(f"Filtered down to the top {len(top_videos)} videos from {len(analyzed_videos)} analyzed.")
+        logger.info("Filtered down to the top %s videos from %s analyzed.", len(top_videos), len(analyzed_videos))
         
         return top_videos, analyzed_videos
     
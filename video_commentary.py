@@ -2,49 +2,81 @@
 
 import os
 import asyncio
-import json
 import logging
 from pathlib import Path
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, TYPE_CHECKING
 
+import orjson
 import aiohttp
+import aiofiles
 from TikTokApi import TikTokApi
-import google.genai as genai
 from pydantic import BaseModel, Field
 from tenacity import retry, stop_after_attempt, wait_exponential
 
+from video_fetcher import get_cached_comments
+
+if TYPE_CHECKING:
+    # Only needed for annotations; the client instance is created and passed in by main
+    import google.genai as genai
+
 # --- Pydantic Model for LLM Output ---
 class VideoScript(BaseModel):
     script: str = Field(description="An engaging and humorous 2-3 sentence script to introduce the video. It should be written in A1 English.")
 
 # --- Logging Setup ---
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 # --- Configuration ---
 DOWNLOADS_DIR = Path("downloads")
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
 
 class CommentaryGenerator:
     """
     Generates scripts for curated videos, downloads them, and prepares a final
     package for the video editor.
     """
-    def __init__(self, gemini_client: genai.Client, tiktok_api: TikTokApi, config: dict):
+    def __init__(self, gemini_client: "genai.Client", tiktok_api: TikTokApi, config: dict):
         self.client = gemini_client
         self.tiktok_api = tiktok_api
         self.model = config.get('gemini_model')
         self.script_prompt_config = config.get('prompts', {}).get('script_generation', {})
         self.MAX_COMMENTS = config.get('max_comments_for_scripting', 20)
+        # Separate limits per bottleneck: TikTok comments and Gemini calls; downloads are
+        # bounded by the number of download workers
+        self.comment_semaphore = asyncio.Semaphore(config.get('max_concurrent_comment_fetches', 8))
+        self.llm_semaphore = asyncio.Semaphore(config.get('max_concurrent_llm_calls', 4))
+        self.MAX_DOWNLOADS = config.get('max_concurrent_downloads', 4)
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    async def __aenter__(self) -> "CommentaryGenerator":
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        """Lazily creates one session shared by all downloads, so CDN connections are kept alive."""
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=16, ttl_dns_cache=300)
+            )
+        return self._session
+
+    async def close(self):
+        """Closes the shared download session, if one was opened."""
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
 
     @retry(wait=wait_exponential(multiplier=1, max=10), stop=stop_after_attempt(3))
     async def get_comments_for_video(self, video_id: str) -> List[str]:
         """Fetches top comments for context with retry logic."""
-        logger.info(f"Fetching comments for video ID {video_id} for script context...")
+        logger.info("Fetching comments for video ID %s for script context...", video_id)
         try:
-            video = self.tiktok_api.video(id=video_id)
-            return [comment.text async for comment in video.comments(count=self.MAX_COMMENTS)]
+            async with self.comment_semaphore:
+                return await get_cached_comments(self.tiktok_api, video_id, self.MAX_COMMENTS)
         except Exception as e:
-            logger.error(f"Could not fetch comments for video {video_id}: {e}")
+            logger.error("Could not fetch comments for video %s: %s", video_id, e)
             raise
 
     @retry(wait=wait_exponential(multiplier=2, max=15), stop=stop_after_attempt(3))
@@ -53,21 +85,27 @@ class CommentaryGenerator:
         prompt = self.script_prompt_config.get('prompt_template', '').format(
             video_description=video_data.get('description', 'No description provided.'),
             author_username=video_data.get('author_username'),
-            comments_json=json.dumps(comments, indent=2)
+            comments_json=orjson.dumps(comments, option=orjson.OPT_INDENT_2).decode()
         )
-        logger.info(f"Generating script for video {video_data['video_id']}...")
+        logger.info("Generating script for video %s...", video_data['video_id'])
         try:
-            gen_config = {'response_mime_type': 'application/json', 'response_schema': VideoScript}
-            response = self.client.generate_content(
-                model=self.model,
-                contents=prompt,
-                generation_config=gen_config,
-                system_instruction=self.script_prompt_config.get('system_instruction')
-            )
-            response_json = json.loads(response.text)
-            return response_json.get("script")
+            gen_config = {
+                'response_mime_type': 'application/json',
+                'response_schema': VideoScript,
+                'system_instruction': self.script_prompt_config.get('system_instruction'),
+            }
+            async with self.llm_semaphore:
+                response = await self.client.aio.models.generate_content(
+                    model=self.model,
+                    contents=prompt,
+                    config=gen_config
+                )
+            # The SDK validates the response against response_schema; parse by hand only if it couldn't
+            if isinstance(response.parsed, VideoScript):
+                return response.parsed.script
+            return orjson.loads(response.text).get("script")
         except Exception as e:
-            logger.error(f"Failed to generate script for video {video_data['video_id']}: {e}")
+            logger.error("Failed to generate script for video %s: %s", video_data['video_id'], e)
             raise
 
     @retry(wait=wait_exponential(multiplier=2, max=10), stop=stop_after_attempt(3))
@@ -77,48 +115,76 @@ class CommentaryGenerator:
         project_dir.mkdir(parents=True, exist_ok=True)
         file_path = project_dir / f"{video_id}.mp4"
         
-        logger.info(f"Downloading video {video_id} to {file_path}...")
+        logger.info("Downloading video %s to %s...", video_id, file_path)
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(video_url) as response:
-                    response.raise_for_status()
-                    with open(file_path, "wb") as f:
-                        f.write(await response.read())
-                    logger.info(f"Successfully downloaded {file_path}.")
-                    return str(file_path)
+            async with self._get_session().get(video_url) as response:
+                response.raise_for_status()
+                async with aiofiles.open(file_path, "wb") as f:
+                    async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                        await f.write(chunk)
+                logger.info("Successfully downloaded %s.", file_path)
+                return str(file_path)
         except Exception as e:
-            logger.error(f"An error occurred during video download for {video_id}: {e}")
+            logger.error("An error occurred during video download for %s: %s", video_id, e)
             return None # Don't retry on file write errors etc.
 
-    async def process_single_video(self, project_id: int, video: dict) -> dict:
-        """Orchestrates script generation and download for one video."""
+    async def generate_script_for_video(self, video: dict) -> Optional[str]:
+        """Fetches comment context and generates the script for one video."""
         comments = await self.get_comments_for_video(video['video_id'])
-        script = await self.generate_script(video, comments)
-        
-        file_path = None
-        if video.get('video_url'):
-            file_path = await self.download_video(project_id, video['video_id'], video['video_url'])
-        else:
-            logger.warning(f"Video {video['video_id']} has no valid URL. Skipping download.")
-        
-        return {
-            "db_id": video['id'],
-            "video_id": video['video_id'],
-            "author": video['author_username'],
-            "description": video['description'],
-            "stats": video['stats'],
-            "cover_image_url": video['cover_url'],
-            "local_file_path": file_path,
-            "generated_script": script,
-            "script": script, # For db update
-            "file_path": file_path # for db update
-        }
+        return await self.generate_script(video, comments)
+
+    async def _download_worker(self, project_id: int, queue: asyncio.Queue, file_paths: Dict[str, Optional[str]]):
+        """Pulls videos off the download queue one at a time until cancelled."""
+        while True:
+            video = await queue.get()
+            try:
+                file_paths[video['video_id']] = await self.download_video(project_id, video['video_id'], video['video_url'])
+            except Exception as e:
+                logger.error("Download worker failed on video %s: %s", video['video_id'], e)
+            finally:
+                queue.task_done()
 
     async def process_project_videos_concurrently(self, project_id: int, videos_to_process: List[Dict]) -> List[Dict]:
-        """Processes all videos for a project concurrently."""
-        tasks = [self.process_single_video(project_id, video) for video in videos_to_process]
-        processed_videos = await asyncio.gather(*tasks)
-        return [v for v in processed_videos if v is not None]
+        """
+        Processes all videos for a project concurrently: scripts are generated for every
+        video while a fixed pool of download workers drains a queue of video URLs.
+        """
+        download_queue = asyncio.Queue()
+        for video in videos_to_process:
+            if video.get('video_url'):
+                download_queue.put_nowait(video)
+            else:
+                logger.warning("Video %s has no valid URL. Skipping download.", video['video_id'])
+
+        file_paths: Dict[str, Optional[str]] = {}
+        workers = [
+            asyncio.create_task(self._download_worker(project_id, download_queue, file_paths))
+            for _ in range(min(self.MAX_DOWNLOADS, download_queue.qsize()))
+        ]
+        try:
+            scripts = await asyncio.gather(*(self.generate_script_for_video(video) for video in videos_to_process))
+            await download_queue.join()
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+        processed_videos = []
+        for video, script in zip(videos_to_process, scripts):
+            file_path = file_paths.get(video['video_id'])
+            processed_videos.append({
+                "db_id": video['id'],
+                "video_id": video['video_id'],
+                "author": video['author_username'],
+                "description": video['description'],
+                "stats": video['stats'],
+                "cover_image_url": video['cover_url'],
+                "local_file_path": file_path,
+                "generated_script": script,
+                "script": script, # For db update
+                "file_path": file_path # for db update
+            })
+        return processed_videos
 
     async def create_summary_file(self, project_id: int, processed_videos: List[Dict]):
         """Creates the final JSON file for the video editor."""
@@ -128,9 +194,9 @@ class CommentaryGenerator:
         # Clean up data for the final JSON
         final_data = [{k: v for k, v in video.items() if k not in ['db_id', 'script', 'file_path']} for video in processed_videos]
 
-        with open(summary_file_path, 'w', encoding='utf-8') as f:
-            json.dump(final_data, f, indent=4)
-        logger.info(f"Final data package saved to {summary_file_path}")
+        with open(summary_file_path, 'wb') as f:
+            f.write(orjson.dumps(final_data, option=orjson.OPT_INDENT_2))
+        logger.info("Final data package saved to %s", summary_file_path)
 
 
 
@@ -1,16 +1,50 @@
 # video_fetcher.py
 
+import asyncio
 import logging
-from typing import List, Dict, Optional
+from collections import OrderedDict
+from typing import List, Dict, Optional, Tuple
 
 from TikTokApi import TikTokApi
 from TikTokApi.exceptions import TikTokException
 from tenacity import retry, stop_after_attempt, wait_exponential, RetryError
 
 # --- Logging Setup ---
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# --- Shared Comment Cache ---
+# The analyze and generate steps both need the comments of the same top videos;
+# in-flight/finished fetches are shared by video ID so each video is fetched once.
+COMMENTS_CACHE_SIZE = 512
+_comments_cache: "OrderedDict[str, Tuple[int, asyncio.Task]]" = OrderedDict()
+
+async def _fetch_comments(tiktok_api: TikTokApi, video_id: str, count: int) -> List[str]:
+    video = tiktok_api.video(id=video_id)
+    return [comment.text async for comment in video.comments(count=count)]
+
+async def get_cached_comments(tiktok_api: TikTokApi, video_id: str, count: int) -> List[str]:
+    """
+    Returns up to `count` comment texts for a video, reusing an earlier fetch of at
+    least that many comments. Failed fetches are evicted so the caller can retry.
+    """
+    entry = _comments_cache.get(video_id)
+    if entry is None or entry[0] < count:
+        entry = (count, asyncio.create_task(_fetch_comments(tiktok_api, video_id, count)))
+        _comments_cache[video_id] = entry
+        if len(_comments_cache) > COMMENTS_CACHE_SIZE:
+            _comments_cache.popitem(last=False)
+    else:
+        _comments_cache.move_to_end(video_id)
+
+    try:
+        # Shield so one cancelled caller doesn't cancel the fetch others are awaiting
+        comments = await asyncio.shield(entry[1])
+    except Exception:
+        if _comments_cache.get(video_id) is entry:
+            del _comments_cache[video_id]
+        raise
+    return comments[:count]
+
 class TikTokApiFetcher:
     """
     Fetches videos using a shared TikTok-Api instance.
@@ -18,38 +52,44 @@ class TikTokApiFetcher:
     def __init__(self, tiktok_api: TikTokApi):
         self.api = tiktok_api
 
+    @staticmethod
+    def _process_video(video_dict: Dict) -> Dict:
+        """Extracts the fields we store from a raw TikTok video dict, walking each sub-dict once."""
+        get = video_dict.get
+        author = get("author") or {}
+        video = get("video") or {}
+        return {
+            "video_id": get("id"),
+            "author_username": author.get("uniqueId"),
+            "create_time": get("createTime"),
+            "description": get("desc"),
+            "video_url": video.get("playAddr"),
+            "cover_url": video.get("cover"),
+            "stats": get("stats") or {},
+        }
+
     @retry(wait=wait_exponential(multiplier=2, max=10), stop=stop_after_attempt(5))
     async def fetch_trending_videos(self, count: int, region: str = "US") -> Optional[List[Dict]]:
         """
         Fetches trending TikTok videos for a given region with retry logic.
         """
-        logger.info(f"Fetching {count} trending videos for region: '{region}'...")
+        logger.info("Fetching %s trending videos for region: '%s'...", count, region)
         videos_data = []
         try:
             # TikTokApi expects lowercase country codes
             async for video in self.api.trending(count=count, country=region.lower()):
-                video_dict = video.as_dict
-                processed_video = {
-                    "video_id": video_dict.get("id"),
-                    "author_username": video_dict.get("author", {}).get("uniqueId"),
-                    "create_time": video_dict.get("createTime"),
-                    "description": video_dict.get("desc"),
-                    "video_url": video_dict.get("video", {}).get("playAddr"),
-                    "cover_url": video_dict.get("video", {}).get("cover"),
-                    "stats": video_dict.get("stats", {}),
-                }
-                videos_data.append(processed_video)
+                videos_data.append(self._process_video(video.as_dict))
                 if len(videos_data) >= count:
                     break
             
-            logger.info(f"Successfully fetched {len(videos_data)} trending videos for '{region}'.")
+            logger.info("Successfully fetched %s trending videos for '%s'.", len(videos_data), region)
             return videos_data
 
         except TikTokException as e:
-            logger.error(f"A TikTok-Api error occurred while fetching trending videos for '{region}': {e}")
+            logger.error("A TikTok-Api error occurred while fetching trending videos for '%s': %s", region, e)
             raise # Reraise to trigger tenacity retry
         except Exception as e:
-            logger.error(f"An unexpected error occurred during trending video fetching for '{region}': {e}")
+            logger.error("An unexpected error occurred during trending video fetching for '%s': %s", region, e)
             raise # Reraise to trigger tenacity retry
 
     @retry(wait=wait_exponential(multiplier=2, max=10), stop=stop_after_attempt(5))
@@ -57,30 +97,20 @@ class TikTokApiFetcher:
         """
         Fetches videos for a given keyword with retry logic.
         """
-        logger.info(f"Fetching {count} videos for keyword: '{keyword}'...")
+        logger.info("Fetching %s videos for keyword: '%s'...", count, keyword)
         videos_data = []
         try:
             async for video in self.api.search.videos(keyword, count=count):
-                video_dict = video.as_dict
-                processed_video = {
-                    "video_id": video_dict.get("id"),
-                    "author_username": video_dict.get("author", {}).get("uniqueId"),
-                    "create_time": video_dict.get("createTime"),
-                    "description": video_dict.get("desc"),
-                    "video_url": video_dict.get("video", {}).get("playAddr"),
-                    "cover_url": video_dict.get("video", {}).get("cover"),
-                    "stats": video_dict.get("stats", {}),
-                }
-                videos_data.append(processed_video)
+                videos_data.append(self._process_video(video.as_dict))
                 if len(videos_data) >= count:
                     break
             
-            logger.info(f"Successfully fetched {len(videos_data)} videos for '{keyword}'.")
+            logger.info("Successfully fetched %s videos for '%s'.", len(videos_data), keyword)
             return videos_data
 
         except TikTokException as e:
-            logger.error(f"A TikTok-Api error occurred while fetching for '{keyword}': {e}")
+            logger.error("A TikTok-Api error occurred while fetching for '%s': %s", keyword, e)
             raise # Reraise to trigger tenacity retry
         except Exception as e:
-            logger.error(f"An unexpected error occurred during video fetching for '{keyword}': {e}")
+            logger.error("An unexpected error occurred during video fetching for '%s': %s", keyword, e)
             raise # Reraise to trigger tenacity retry
\ No newline at end of file